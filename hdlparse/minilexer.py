@@ -20,6 +20,7 @@ class MiniLexer(object):
       flags (int): Optional regex flags
     '''
     self.tokens = {}
+    self.fused = {}
 
     # Pre-process the state definitions
     for state, patterns in tokens.iteritems():
@@ -38,6 +39,31 @@ class MiniLexer(object):
 
         full_patterns.append((pat, action, new_state))
       self.tokens[state] = full_patterns
+      self.fused[state] = self._fuse_patterns(full_patterns, flags)
+
+
+  def _fuse_patterns(self, patterns, flags):
+    '''Combine the patterns of a state into a single alternation
+
+    Alternatives are tried in order so the first rule that matches at a
+    position wins, the same as testing each pattern individually.
+
+    Args:
+      patterns (list): Compiled rules for a state
+      flags (int): Regex flags
+    Returns:
+      Tuple of the combined regex and a dict mapping the index of each
+      enclosing group to its action, new state, and range of subgroups.
+    '''
+    alternatives = []
+    rules = {}
+    group = 1
+    for pat, action, new_state in patterns:
+      alternatives.append('({})'.format(pat.pattern))
+      rules[group] = (action, new_state, group, group + pat.groups)
+      group += pat.groups + 1
+
+    return re.compile('|'.join(alternatives), flags), rules
 
 
   def run(self, text):
@@ -53,35 +79,26 @@ class MiniLexer(object):
     stack = ['root']
     pos = 0
 
-    patterns = self.tokens[stack[-1]]
+    regex, rules = self.fused[stack[-1]]
 
     while True:
-      for pat, action, new_state in patterns:
-        m = pat.match(text, pos)
-        if m:
-          if action:
-            #print('## MATCH: {} -> {}'.format(m.group(), action))
-            yield (pos, m.end()-1), action, m.groups()
-
-          pos = m.end()
-
-          if new_state:
-            if isinstance(new_state, int): # Pop states
-              del stack[new_state:]
-            else:
-              stack.append(new_state)
-
-            #print('## CHANGE STATE:', pos, new_state, stack)
-            patterns = self.tokens[stack[-1]]
-
-          break
-
-      else:
-        try:
-          if text[pos] == '\n':
-            pos += 1
-            continue
-          pos += 1
-        except IndexError:
-          break
-
+      # Text that no rule matches is skipped by the search
+      m = regex.search(text, pos)
+      if not m:
+        break
+
+      action, new_state, start, end = rules[m.lastindex]
+      if action:
+        #print('## MATCH: {} -> {}'.format(m.group(), action))
+        yield (m.start(), m.end()-1), action, m.groups()[start:end]
+
+      pos = m.end()
+
+      if new_state:
+        if isinstance(new_state, int): # Pop states
+          del stack[new_state:]
+        else:
+          stack.append(new_state)
+
+        #print('## CHANGE STATE:', pos, new_state, stack)
+        regex, rules = self.fused[stack[-1]]
@@ -3,11 +3,17 @@
 # Distributed under the terms of the MIT license
 from __future__ import print_function
 
-import re, os, io, ast, pprint, collections
-from .minilexer import MiniLexer
+import re, os, io, sys, ast, pprint, collections, hashlib, tempfile, multiprocessing
+import cPickle as pickle
+from operator import attrgetter
+from .minilexer import MiniLexer, __version__
 
 '''Verilog documentation parser'''
 
+# Revision of the persistent cache entries. Bump this whenever the parser
+# output or the layout of the parsed objects changes.
+cache_format = 2
+
 verilog_tokens = {
   'root': [
     (r'(`ifdef|`ifndef)\s+(\w+)', 'define'),
@@ -21,7 +27,7 @@ verilog_tokens = {
     (r'(`ifdef|`ifndef)\s+(\w+)', 'define'),
     (r'`endif', 'endif'),
     (r'parameter\s*(signed|integer|realtime|real|time)?\s*(\[[^]]+\])?', 'parameter_start', 'parameters'),
-    (r'(input|inout|output)\s*(reg|supply0|supply1|tri|triand|trior|tri0|tri1|wire|wand|wor)?\s*(signed)?\s*(\[[`]?[^]]+\])?(\[[`]?[^]]+\])?', 'module_port_start', 'module_port'),
+    (r'\b(input|inout|output)\b\s*(?:(reg|supply0|supply1|tri|triand|trior|tri0|tri1|wire|wand|wor)\b)?\s*(?:(signed)\b)?\s*(\[[`]?[^]]+\])?(\[[`]?[^]]+\])?', 'module_port_start', 'module_port'),
     (r'endmodule', 'end_module', '#pop'),
     (r'/\*', 'block_comment', 'block_comment'),
     (r'//#\s*{{(.*)}}\n', 'section_meta'),
@@ -38,7 +44,7 @@ verilog_tokens = {
   'module_port': [
     (r'(`ifdef|`ifndef)\s+(\w+)', 'define'),
     (r'`endif', 'endif'),
-    (r'\s*(input|inout|output)\s*(reg|supply0|supply1|tri|triand|trior|tri0|tri1|wire|wand|wor)?\s*(signed)?\s*(\[[`]?[^]]+\])?(\[[`]?[^]]+\])?', 'module_port_start'),
+    (r'\s*\b(input|inout|output)\b\s*(?:(reg|supply0|supply1|tri|triand|trior|tri0|tri1|wire|wand|wor)\b)?\s*(?:(signed)\b)?\s*(\[[`]?[^]]+\])?(\[[`]?[^]]+\])?', 'module_port_start'),
     (r'\s*(\w+)\s*,?', 'port_param'),
     (r'[);]', None, '#pop'),
     (r'//#\s*{{(.*)}}\n', 'section_meta'),
@@ -55,20 +61,41 @@ VerilogLexer = MiniLexer(verilog_tokens)
 
 class VerilogObject(object):
   '''Base class for parsed Verilog objects'''
+  __slots__ = ('name', 'kind', 'desc', 'define')
+
   def __init__(self, name, desc=None, define=None):
     self.name = name
     self.kind = 'unknown'
     self.desc = desc
     self.define = define
 
+  def __getstate__(self):
+    # Slotted objects have no __dict__ so pickle protocols 0 and 1 need
+    # the state collected from the slots of every class in the hierarchy
+    state = {}
+    for cls in type(self).__mro__:
+      for attr in getattr(cls, '__slots__', ()):
+        if hasattr(self, attr):
+          state[attr] = getattr(self, attr)
+    return state
+
+  def __setstate__(self, state):
+    for attr, value in state.items():
+      setattr(self, attr, value)
+
 class VerilogParameter(VerilogObject):
   '''Parameter and port to a module'''
+  __slots__ = ('mode', 'data_type', 'default_value')
+
   def __init__(self, name, mode=None, data_type=None, default_value=None, desc=None, define=None):
-    super(VerilogParameter, self).__init__(name, desc, define)
+    # Set base fields directly since this is created for every port
+    self.name = name
+    self.kind = 'unknown'
+    self.desc = desc
+    self.define = define
     self.mode = mode
     self.data_type = data_type
     self.default_value = default_value
-    self.desc = desc
 
   def __str__(self):
     if self.mode is not None:
@@ -84,13 +111,28 @@ class VerilogParameter(VerilogObject):
 
 class VerilogModule(VerilogObject):
   '''Module definition'''
+  __slots__ = ('generics', '_ports', 'sections')
+
   def __init__(self, name, ports, generics=None, sections=None, desc=None, define=None):
     super(VerilogModule, self).__init__(name, desc, define)
     self.kind = 'module'
     # Verilog params
     self.generics = generics if generics is not None else []
-    self.ports = ports
+    # A dict of ports is only sorted into a list when first accessed
+    self._ports = ports
     self.sections = sections if sections is not None else {}
+
+  @property
+  def ports(self):
+    '''List of ports sorted by name'''
+    if isinstance(self._ports, dict):
+      self._ports = sorted(self._ports.values(), key=attrgetter('name'))
+    return self._ports
+
+  @ports.setter
+  def ports(self, ports):
+    self._ports = ports
+
   def __repr__(self):
     return "VerilogModule('{}') {}".format(self.name, self.ports)
 
@@ -126,7 +168,6 @@ def parse_verilog(text):
 
   metacomments = []
   parameters = []
-  param_items = []
 
   generics = []
   ports = collections.OrderedDict()
@@ -135,31 +176,43 @@ def parse_verilog(text):
   last_item = None
   array_range_start_pos = 0
   current_define = []
+  define = None # Innermost active conditional
+  # Ports share a handful of distinct mode and type strings
+  interned = {}
 
   objects = []
 
   for pos, action, groups in lex.run(text):
     #print("pos: {}, action: {}, groups: {}".format(pos, action, groups))
-    if action == 'metacomment':
+    # Ports are by far the most common token so they are checked first
+    if action == 'port_param':
+      ident = groups[0]
+
+      last_item = VerilogParameter(ident, mode, ptype, define=define)
+      ports[(ident, define)] = last_item
+      port_param_index += 1
+
+    elif action == 'metacomment':
       if last_item is None:
         metacomments.append(groups[0])
       else:
         last_item.desc = groups[0]
 
-    if action == 'section_meta':
+    elif action == 'section_meta':
       sections.append((port_param_index, groups[0]))
     elif action == 'define':
       current_define.append(groups[0] + "=" + groups[1])
+      define = current_define[-1]
     elif action == 'endif':
       if len(current_define) == 0:
         raise Exception("No matching '`ifdef'' or '`ifndef' for the '`endif'")
       current_define.pop()
+      define = None if len(current_define) == 0 else current_define[-1]
     elif action == 'module':
       kind = 'module'
       name = groups[0]
       generics = []
       ports = collections.OrderedDict()
-      param_items = []
       sections = []
       port_param_index = 0
     elif action == 'parameter_start':
@@ -172,10 +225,10 @@ def parse_verilog(text):
       if vec_range is not None:
         new_ptype += ' ' + vec_range
 
-      ptype = new_ptype
+      ptype = interned.setdefault(new_ptype, new_ptype)
 
     elif action == 'param_item':
-      generics.append(VerilogParameter(groups[0], 'in', ptype, groups[1], define=None if len(current_define) == 0 else current_define[-1]))
+      generics.append(VerilogParameter(groups[0], 'in', ptype, groups[1], define=define))
 
     elif action == 'module_port_start':
       new_mode, net_type, signed, vec_range, array_spec = groups
@@ -193,33 +246,14 @@ def parse_verilog(text):
       if array_spec is not None:
         new_ptype += array_spec
 
-      # Complete pending items
-      for i in param_items:
-        ports[i] = VerilogParameter(i[0], mode, ptype, define=i[1])
-
-      param_items = []
-      if len(ports) > 0:
-        last_item = next(reversed(ports))
-
       # Start with new mode
-      mode = new_mode
-      ptype = new_ptype
-
-    elif action == 'port_param':
-      ident = groups[0]
-
-      param_items.append((ident, None if len(current_define) == 0 else current_define[-1]))
-      port_param_index += 1
+      mode = interned.setdefault(new_mode, new_mode)
+      ptype = interned.setdefault(new_ptype, new_ptype)
 
     elif action == 'end_module':
       if len(current_define) > 0:
         raise Exception("'%s' is not terminated with a matching '`endif'" % current_define[-1].replace('=',' '))
-      # Finish any pending ports
-      for i in param_items:
-        ports[i] = VerilogParameter(i[0], mode, ptype, define=i[1])
-      lports = list(ports.values())
-      lports.sort(key=lambda x: x.name)
-      vobj = VerilogModule(name, lports, generics, dict(sections), metacomments, define=None if len(current_define) == 0 else current_define[-1])
+      vobj = VerilogModule(name, ports, generics, dict(sections), metacomments, define=define)
       objects.append(vobj)
       last_item = None
       metacomments = []
@@ -227,6 +261,16 @@ def parse_verilog(text):
   return objects
 
 
+def _parse_verilog_source(fname):
+  '''Parse a UTF-8 Verilog file
+
+  This is kept at module level so it can be sent to worker processes.
+  '''
+  with io.open(fname, 'rt', encoding='utf-8') as fh:
+    text = fh.read()
+  return parse_verilog(text)
+
+
 def is_verilog(fname):
   '''Identify file as Verilog by its extension
   
@@ -239,9 +283,14 @@ def is_verilog(fname):
 
 
 class VerilogExtractor(object):
-  '''Utility class that caches parsed objects'''
-  def __init__(self):
+  '''Utility class that caches parsed objects
+
+  Args:
+    cache_dir (str, optional): Directory to persist parsed objects between runs
+  '''
+  def __init__(self, cache_dir=None):
     self.object_cache = {}
+    self.cache_dir = cache_dir
 
   def extract_objects(self, fname, type_filter=None):
     '''Extract objects from a source file
@@ -256,10 +305,11 @@ class VerilogExtractor(object):
     if fname in self.object_cache:
       objects = self.object_cache[fname]
     else:
-      with io.open(fname, 'rt', encoding='utf-8') as fh:
-        text = fh.read()
-        objects = parse_verilog(text)
-        self.object_cache[fname] = objects
+      objects = self._load_cached_objects(fname)
+      if objects is None:
+        objects = _parse_verilog_source(fname)
+        self._save_cached_objects(fname, objects)
+      self.object_cache[fname] = objects
 
     if type_filter:
       objects = [o for o in objects if isinstance(o, type_filter)]
@@ -267,6 +317,97 @@ class VerilogExtractor(object):
     return objects
 
 
+  def extract_objects_batch(self, fnames, type_filter=None, processes=None):
+    '''Extract objects from multiple source files in parallel
+
+    Files not already cached are parsed by a pool of worker processes.
+
+    Args:
+      fnames (list of str): Names of files to read from
+      type_filter (class, optional): Object class to filter results
+      processes (int, optional): Number of worker processes. Defaults to the CPU count.
+    Returns:
+      Dict of object lists keyed by file name.
+    '''
+    pending = []
+    seen = set()
+    for fname in fnames:
+      if fname in self.object_cache or fname in seen:
+        continue
+      seen.add(fname)
+      objects = self._load_cached_objects(fname)
+      if objects is None:
+        pending.append(fname)
+      else:
+        self.object_cache[fname] = objects
+
+    if len(pending) > 1:
+      pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(pending)))
+      try:
+        results = pool.map(_parse_verilog_source, pending)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = [_parse_verilog_source(fname) for fname in pending]
+
+    for fname, objects in zip(pending, results):
+      self._save_cached_objects(fname, objects)
+      self.object_cache[fname] = objects
+
+    return dict((fname, self.extract_objects(fname, type_filter)) for fname in fnames)
+
+
+  def _cache_file(self, fname):
+    '''Get the path to the persistent cache entry for a source file
+
+    The key covers the file's modification time and size so edited files
+    are parsed again. It also covers the cache format and the Python major
+    version since Python 2 can't load pickles written by Python 3.
+    '''
+    st = os.stat(fname)
+    key = '{}:{!r}:{}:{}:{}:{}'.format(os.path.abspath(fname), st.st_mtime, st.st_size,
+      __version__, cache_format, sys.version_info[0])
+    return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+
+  def _load_cached_objects(self, fname):
+    '''Load previously parsed objects from the persistent cache
+
+    Returns:
+      List of objects or None when there is no valid cache entry.
+    '''
+    if self.cache_dir is None:
+      return None
+
+    try:
+      with open(self._cache_file(fname), 'rb') as fh:
+        return pickle.load(fh)
+    except Exception:
+      return None
+
+  def _save_cached_objects(self, fname, objects):
+    '''Store parsed objects in the persistent cache'''
+    if self.cache_dir is None:
+      return
+
+    try:
+      cache_file = self._cache_file(fname)
+      if not os.path.isdir(self.cache_dir):
+        os.makedirs(self.cache_dir)
+
+      # Write to a temp file first so readers never see a partial entry
+      fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+      try:
+        with os.fdopen(fd, 'wb') as fh:
+          pickle.dump(objects, fh, pickle.HIGHEST_PROTOCOL)
+        getattr(os, 'replace', os.rename)(tmp_name, cache_file)
+      finally:
+        if os.path.exists(tmp_name):
+          os.remove(tmp_name)
+    except (IOError, OSError):
+      pass
+
+
   def extract_objects_from_source(self, text, type_filter=None):
     '''Extract object declarations from a text buffer
 